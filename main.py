@@ -8,16 +8,27 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import sys
 import json
+import signal
 import asyncio
+import random
+import hashlib
+import time
+import copy
+import functools
+import itertools
+from collections import deque
 from datetime import datetime
+from enum import IntEnum
 from typing import Optional
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 
 import oci
+import orjson
 import secrets
 from fastapi import FastAPI, Request, BackgroundTasks, Depends, HTTPException, status
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
@@ -44,14 +55,33 @@ def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
 
 # Global state
 class AppState:
-    is_running: bool = False
-    should_stop: bool = False
-    current_attempt: int = 0
-    last_status: str = "Idle"
-    logs: list = []
-    vm_created: bool = False
-    vm_details: Optional[dict] = None
+    stop_event: Optional[asyncio.Event] = None
+    # Status fields live in one dict that is replaced (never mutated) on each
+    # update, so readers always see a consistent set of values
+    snapshot: dict = {
+        "is_running": False,
+        "current_attempt": 0,
+        "last_status": "Idle",
+        "vm_created": False,
+        "vm_details": None,
+    }
+    logs: deque = deque(maxlen=500)  # Keep only last 500 logs
+    log_offset: int = 0  # Entries dropped from the front, keeps log indices absolute
     task: Optional[asyncio.Task] = None
+    compute_client: Optional[oci.core.ComputeClient] = None
+    # index.html has no per-request variables, so it is rendered once at startup
+    index_body: bytes = b""
+    index_etag: str = ""
+    # SSE wake-up: bumped on every log/status change, streams wait on log_cond
+    log_cond: Optional[asyncio.Condition] = None
+    status_version: int = 0
+    notify_task: Optional[asyncio.Task] = None
+    # Console output is queued and written in batches by log_writer
+    log_q: Optional[asyncio.Queue] = None
+    log_writer_task: Optional[asyncio.Task] = None
+    # Launch throttling across all AD attempts
+    launch_sem: Optional[asyncio.Semaphore] = None
+    next_launch_at: float = 0.0
 
 state = AppState()
 
@@ -78,7 +108,8 @@ missing_vars = [var for var in REQUIRED_ENV_VARS if not os.getenv(var)]
 if missing_vars:
     raise RuntimeError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
-# Configuration from environment variables
+# Configuration from environment variables (read once - env is fixed at startup)
+@functools.lru_cache(maxsize=1)
 def get_config():
     return {
         "tenancy_ocid": os.getenv("OCI_TENANCY_OCID"),
@@ -97,6 +128,7 @@ def get_config():
         "ad_delay": int(os.getenv("OCI_AD_DELAY")),
     }
 
+@functools.lru_cache(maxsize=1)
 def get_oci_config():
     """Create OCI config dict from environment variables"""
     cfg = get_config()
@@ -114,145 +146,386 @@ AVAILABILITY_DOMAINS = [
     "FpAe:US-ASHBURN-AD-2",
     "FpAe:US-ASHBURN-AD-3",
 ]
+# (ad, short name) pairs, e.g. ("FpAe:US-ASHBURN-AD-1", "AD-1")
+AD_ENTRIES = [(ad, "-".join(ad.split("-")[-2:])) for ad in AVAILABILITY_DOMAINS]
+
+# Retry backoff: base is OCI_RETRY_INTERVAL, doubled after each all-capacity sweep
+BACKOFF_CAP = 900          # Max wait between sweeps (seconds)
+BACKOFF_JITTER = 0.5       # +/- fraction applied to each wait
+LIMIT_EXCEEDED_WAIT = 3600 # Retrying soon won't help when a service limit is hit
+
+# Launch throttling: cap in-flight launches and space out their start times
+LAUNCH_CONCURRENCY = 2
+LAUNCH_MIN_INTERVAL = 0.5  # Seconds between launch requests
+
+def get_backoff_delay(base: int, attempt: int) -> float:
+    """Exponential backoff with jitter, capped at BACKOFF_CAP"""
+    delay = base * (2 ** min(attempt, 16))  # Bound the exponent; the cap applies anyway
+    return min(BACKOFF_CAP, delay * (1 + random.uniform(-BACKOFF_JITTER, BACKOFF_JITTER)))
 
 def add_log(message: str, level: str = "info"):
     """Add a log entry with timestamp"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
     entry = {"timestamp": timestamp, "message": message, "level": level}
+    if len(state.logs) == state.logs.maxlen:
+        state.log_offset += 1
     state.logs.append(entry)
-    # Keep only last 500 logs
-    if len(state.logs) > 500:
-        state.logs = state.logs[-500:]
-    print(f"[{timestamp}] [{level.upper()}] {message}")
+    line = f"[{timestamp}] [{level.upper()}] {message}\n"
+    if state.log_q is None:
+        sys.stdout.write(line)
+    else:
+        try:
+            state.log_q.put_nowait(line)
+        except asyncio.QueueFull:
+            # Drop the oldest line rather than block the event loop
+            state.log_q.get_nowait()
+            state.log_q.task_done()
+            state.log_q.put_nowait(line)
+    notify_clients()
+
+LOG_WRITE_BATCH = 64  # Max console lines per write
+
+def write_stdout(text: str):
+    """Write and flush console output (blocking - run in a worker thread)"""
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+async def log_writer():
+    """Drain queued console lines in batches, writing from a worker thread"""
+    buf = []
+    while True:
+        buf.append(await state.log_q.get())
+        while len(buf) < LOG_WRITE_BATCH and not state.log_q.empty():
+            buf.append(state.log_q.get_nowait())
+        await asyncio.to_thread(write_stdout, "".join(buf))
+        for _ in buf:
+            state.log_q.task_done()
+        buf.clear()
+
+def get_logs_since(index: int) -> tuple[list, int]:
+    """Return logs from absolute index onwards, plus the new absolute total"""
+    start = max(index - state.log_offset, 0)
+    return list(itertools.islice(state.logs, start, None)), state.log_offset + len(state.logs)
+
+def update_status(**changes):
+    """Swap in a new status snapshot and wake SSE streams"""
+    state.snapshot = {**state.snapshot, **changes}
+    notify_clients()
+
+def notify_clients():
+    """Wake SSE streams after a log/status change (callable from sync code on the loop)"""
+    state.status_version += 1
+    if state.log_cond is not None and state.notify_task is None:
+        state.notify_task = asyncio.get_running_loop().create_task(_notify_clients())
+
+async def _notify_clients():
+    state.notify_task = None
+    async with state.log_cond:
+        state.log_cond.notify_all()
+
+def write_result(path: str, payload: dict):
+    """Write result JSON atomically (temp file + rename) so a crash can't truncate it"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+def build_launch_details(config: dict) -> oci.core.models.LaunchInstanceDetails:
+    """Build the AD-independent launch details once per creation loop"""
+    return oci.core.models.LaunchInstanceDetails(
+        compartment_id=config["compartment_id"],
+        shape="VM.Standard.A1.Flex",
+        shape_config=oci.core.models.LaunchInstanceShapeConfigDetails(
+            ocpus=config["ocpus"],
+            memory_in_gbs=config["memory_gbs"]
+        ),
+        image_id=config["image_id"],
+        display_name=config["display_name"],
+        create_vnic_details=oci.core.models.CreateVnicDetails(
+            subnet_id=config["subnet_id"],
+            assign_public_ip=True
+        ),
+        metadata={
+            "ssh_authorized_keys": config["ssh_public_key"]
+        }
+    )
+
+class ErrorKind(IntEnum):
+    """Launch failure classification, drives the retry backoff"""
+    CAPACITY = 1
+    LIMIT = 2
+    OTHER = 3
 
-async def try_create_vm(compute_client, config: dict, ad: str) -> tuple[bool, str, Optional[dict]]:
+async def try_create_vm(compute_client, base_details: oci.core.models.LaunchInstanceDetails, ad: str) -> tuple[bool, Optional[ErrorKind], str, Optional[dict]]:
     """Try to create VM in specified availability domain"""
     try:
-        launch_details = oci.core.models.LaunchInstanceDetails(
-            compartment_id=config["compartment_id"],
-            availability_domain=ad,
-            shape="VM.Standard.A1.Flex",
-            shape_config=oci.core.models.LaunchInstanceShapeConfigDetails(
-                ocpus=config["ocpus"],
-                memory_in_gbs=config["memory_gbs"]
-            ),
-            image_id=config["image_id"],
-            display_name=config["display_name"],
-            create_vnic_details=oci.core.models.CreateVnicDetails(
-                subnet_id=config["subnet_id"],
-                assign_public_ip=True
-            ),
-            metadata={
-                "ssh_authorized_keys": config["ssh_public_key"]
-            }
-        )
+        # Shallow copy shares the prebuilt nested models; only the AD differs
+        launch_details = copy.copy(base_details)
+        launch_details.availability_domain = ad
 
-        response = compute_client.launch_instance(launch_details)
-        return True, "SUCCESS", response.data.__dict__
+        # SDK call is blocking HTTPS I/O - keep it off the event loop
+        response = await asyncio.to_thread(compute_client.launch_instance, launch_details)
+        return True, None, "SUCCESS", oci.util.to_dict(response.data)
 
     except oci.exceptions.ServiceError as e:
-        if "Out of host capacity" in str(e.message):
-            return False, "Out of capacity", None
-        elif "LimitExceeded" in str(e.code):
-            return False, "Limit exceeded", None
+        # Capacity errors come back as 500 InternalError "Out of host capacity."
+        if e.code == "OutOfCapacity" or (e.status == 500 and "capacity" in (e.message or "")):
+            return False, ErrorKind.CAPACITY, "Out of capacity", None
+        elif e.code == "LimitExceeded":
+            return False, ErrorKind.LIMIT, "Limit exceeded", None
         else:
-            return False, f"Error: {e.message[:100]}", None
+            return False, ErrorKind.OTHER, f"Error: {(e.message or str(e.code))[:100]}", None
     except Exception as e:
-        return False, f"Exception: {str(e)[:100]}", None
+        return False, ErrorKind.OTHER, f"Exception: {str(e)[:100]}", None
+
+async def try_ad(compute_client, base_details: oci.core.models.LaunchInstanceDetails, ad: str, ad_short: str, start_delay: float, launched: set, found: asyncio.Event) -> Optional[tuple[bool, Optional[ErrorKind], str, Optional[dict]]]:
+    """Wait start_delay seconds, then try one AD. Returns None if stopped or another
+    AD succeeded (signalled via found) before launching."""
+    if start_delay:
+        try:
+            await asyncio.wait_for(state.stop_event.wait(), timeout=start_delay)
+            return None
+        except asyncio.TimeoutError:
+            pass
+    if state.stop_event.is_set() or found.is_set():
+        return None
+
+    async with state.launch_sem:
+        # Reserve the next launch slot (no await between read and write)
+        now = asyncio.get_running_loop().time()
+        slot = max(now, state.next_launch_at)
+        state.next_launch_at = slot + LAUNCH_MIN_INTERVAL
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        # Re-check after queueing: another AD may have succeeded, or stop was pressed
+        if state.stop_event.is_set() or found.is_set():
+            return None
+
+        # Must be added only here, immediately before the SDK call: the loop
+        # cancels any task not in `launched` once a VM exists, so an AD that
+        # joins it earlier (while queued/throttled) could launch a second VM
+        launched.add(ad)
+        update_status(
+            current_attempt=state.snapshot["current_attempt"] + 1,
+            last_status=f"Trying {ad_short}...",
+        )
+        add_log(f"Attempt {state.snapshot['current_attempt']} - Trying {ad_short}...", "info")
+
+        result = await try_create_vm(compute_client, base_details, ad)
+        if result[0]:
+            # Set while still holding the slot: the next queued AD wakes before
+            # the main loop records the success, so vm_created isn't set yet
+            found.set()
+        return result
 
 async def vm_creation_loop():
     """Main loop that retries VM creation across availability domains"""
     config = get_config()
-    oci_config = get_oci_config()
 
     # Validate config
     missing = [k for k, v in config.items() if not v and k not in ["display_name", "ocpus", "memory_gbs", "retry_interval"]]
     if missing:
         add_log(f"Missing config: {', '.join(missing)}", "error")
-        state.is_running = False
-        state.last_status = "Config Error"
+        update_status(is_running=False, last_status="Config Error")
         return
 
-    try:
-        compute_client = oci.core.ComputeClient(oci_config)
-    except Exception as e:
-        add_log(f"Failed to create OCI client: {e}", "error")
-        state.is_running = False
-        state.last_status = "OCI Client Error"
-        return
+    # Client is normally built at startup; retry here if that failed
+    if state.compute_client is None:
+        try:
+            state.compute_client = await asyncio.to_thread(oci.core.ComputeClient, get_oci_config())
+        except Exception as e:
+            add_log(f"Failed to create OCI client: {e}", "error")
+            update_status(is_running=False, last_status="OCI Client Error")
+            return
+    compute_client = state.compute_client
+    base_details = build_launch_details(config)
 
     add_log(f"Starting VM creation loop (Shape: VM.Standard.A1.Flex, {config['ocpus']} OCPUs, {config['memory_gbs']} GB RAM)", "info")
-    add_log(f"Retry interval: {config['retry_interval']}s, AD delay: {config['ad_delay']}s", "info")
-
-    state.current_attempt = 0
-
-    while not state.should_stop and not state.vm_created:
-        for ad in AVAILABILITY_DOMAINS:
-            if state.should_stop:
-                break
-
-            state.current_attempt += 1
-            ad_short = ad.split("-")[-1]  # AD-1, AD-2, AD-3
-
-            add_log(f"Attempt {state.current_attempt} - Trying {ad_short}...", "info")
-            state.last_status = f"Trying {ad_short}..."
-
-            success, message, details = await try_create_vm(compute_client, config, ad)
-
-            if success:
-                state.vm_created = True
-                state.vm_details = details
-                state.last_status = "VM Created!"
-                add_log(f"SUCCESS! VM created in {ad_short}!", "success")
-
-                # Save result to file
-                result_file = "vm_creation_result.json"
-                with open(result_file, "w") as f:
-                    json.dump({
-                        "success": True,
-                        "timestamp": datetime.now().isoformat(),
-                        "availability_domain": ad,
-                        "attempts": state.current_attempt,
-                        "details": str(details)
-                    }, f, indent=2, default=str)
-                add_log(f"Result saved to {result_file}", "info")
-                break
+    add_log(f"Retry interval: {config['retry_interval']}s (backoff up to {BACKOFF_CAP}s), AD delay: {config['ad_delay']}s", "info")
+
+    update_status(current_attempt=0)
+    backoff_attempt = 0
+
+    while not state.stop_event.is_set() and not state.snapshot["vm_created"]:
+        sweep_errors = []
+        launched = set()
+        found = asyncio.Event()
+
+        # Launch all ADs concurrently, staggered by OCI_AD_DELAY
+        tasks = {
+            asyncio.create_task(try_ad(compute_client, base_details, ad, ad_short, i * config['ad_delay'], launched, found)): (ad, ad_short)
+            for i, (ad, ad_short) in enumerate(AD_ENTRIES)
+        }
+        pending = set(tasks)
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    result = task.result()
+                    if result is None:  # Skipped - stopped or VM created before launch
+                        continue
+
+                    ad, ad_short = tasks[task]
+                    success, kind, message, details = result
+
+                    if success and state.snapshot["vm_created"]:
+                        # Launch was already in flight when another AD succeeded
+                        add_log(f"Additional VM also created in {ad_short} - check your console", "warning")
+                    elif success:
+                        update_status(vm_created=True, vm_details=details, last_status="VM Created!")
+                        add_log(f"SUCCESS! VM created in {ad_short}!", "success")
+
+                        # Save result to file
+                        result_file = "vm_creation_result.json"
+                        await asyncio.to_thread(write_result, result_file, {
+                            "success": True,
+                            "timestamp": datetime.now().isoformat(),
+                            "availability_domain": ad,
+                            "attempts": state.snapshot["current_attempt"],
+                            "details": details
+                        })
+                        add_log(f"Result saved to {result_file}", "info")
+                    else:
+                        sweep_errors.append(kind)
+                        if kind == ErrorKind.CAPACITY:
+                            add_log(f"  -> Out of capacity in {ad_short}", "warning")
+                        else:
+                            add_log(f"  -> {message}", "warning")
+
+                if state.snapshot["vm_created"]:
+                    # Cancel attempts whose SDK call hasn't started (not in
+                    # `launched`); ones already calling launch_instance can't be
+                    # recalled, so they're drained and an extra VM gets reported
+                    for task in pending:
+                        if tasks[task][0] not in launched:
+                            task.cancel()
+        finally:
+            # Don't leave per-AD tasks running if the loop itself is cancelled
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if not state.snapshot["vm_created"] and not state.stop_event.is_set():
+            if ErrorKind.LIMIT in sweep_errors:
+                # Retrying won't help until the limit is raised or freed
+                delay = LIMIT_EXCEEDED_WAIT
+                backoff_attempt = 0
+            elif sweep_errors and all(k == ErrorKind.CAPACITY for k in sweep_errors):
+                delay = get_backoff_delay(config['retry_interval'], backoff_attempt)
+                backoff_attempt += 1
             else:
-                if "Out of capacity" in message:
-                    add_log(f"  -> Out of capacity in {ad_short}", "warning")
-                else:
-                    add_log(f"  -> {message}", "warning")
-
-                # Delay between AD attempts (not after last AD)
-                if ad != AVAILABILITY_DOMAINS[-1] and not state.should_stop:
-                    await asyncio.sleep(config['ad_delay'])
-
-        if not state.vm_created and not state.should_stop:
-            add_log(f"All ADs tried. Waiting {config['retry_interval']} seconds...", "info")
-            state.last_status = f"Waiting {config['retry_interval']}s..."
-
-            # Wait with cancellation support
-            for _ in range(config['retry_interval']):
-                if state.should_stop:
-                    break
-                await asyncio.sleep(1)
-
-    if state.should_stop and not state.vm_created:
-        add_log("Stopped by user", "info")
-        state.last_status = "Stopped"
+                # Transient/other errors: short backoff, reset exponent
+                delay = get_backoff_delay(config['retry_interval'], 0)
+                backoff_attempt = 0
+
+            add_log(f"All ADs tried. Waiting {delay:.0f} seconds...", "info")
+            update_status(last_status=f"Waiting {delay:.0f}s...")
 
-    state.is_running = False
+            # Wait with cancellation support - wakes immediately on stop
+            try:
+                await asyncio.wait_for(state.stop_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    if state.stop_event.is_set() and not state.snapshot["vm_created"]:
+        add_log("Stopped by user", "info")
+        update_status(last_status="Stopped")
+
+    update_status(is_running=False)
+
+SHUTDOWN_TIMEOUT = 5  # Seconds to wait for the creation loop on shutdown
+
+def install_signal_handlers() -> list:
+    """Stop the creation loop on SIGINT/SIGTERM, then defer to the previous handler.
+    Returns (signal, previous handler) pairs for restore_signal_handlers."""
+    loop = asyncio.get_running_loop()
+    # Handlers registered by the server via loop.add_signal_handler show up as
+    # asyncio's no-op; replacing them would disable the server's own shutdown
+    unix_events = sys.modules.get("asyncio.unix_events")
+    loop_noop = getattr(unix_events, "_sighandler_noop", None)
+    installed = []
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if previous is None or (loop_noop is not None and previous is loop_noop):
+            continue
+
+        def handler(sig=sig, previous=previous):
+            if state.stop_event:
+                state.stop_event.set()
+            if callable(previous):
+                previous(sig, None)
+            else:
+                # SIG_DFL/SIG_IGN: put it back and re-deliver so the process
+                # exits (or ignores the signal) exactly as it would have
+                loop.remove_signal_handler(sig)
+                signal.signal(sig, previous)
+                signal.raise_signal(sig)
+
+        try:
+            loop.add_signal_handler(sig, handler)
+        except (NotImplementedError, RuntimeError):
+            # Unsupported on Windows loops (NotImplementedError) and outside
+            # the main thread, e.g. TestClient or embedded servers (RuntimeError)
+            continue
+        installed.append((sig, previous))
+    return installed
+
+def restore_signal_handlers(installed: list):
+    """Put back the handlers that install_signal_handlers replaced"""
+    loop = asyncio.get_running_loop()
+    for sig, previous in installed:
+        loop.remove_signal_handler(sig)
+        signal.signal(sig, previous)
 
 # FastAPI app
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    state.log_cond = asyncio.Condition()
+    state.launch_sem = asyncio.Semaphore(LAUNCH_CONCURRENCY)
+    state.log_q = asyncio.Queue(maxsize=1000)
+    state.log_writer_task = asyncio.create_task(log_writer())
     add_log("OCI ARM VM Monitor v1.4 started", "info")
+    try:
+        state.compute_client = await asyncio.to_thread(oci.core.ComputeClient, get_oci_config())
+    except Exception as e:
+        add_log(f"Failed to create OCI client: {e}", "error")
+    state.index_body = templates.get_template("index.html").render({"request": None}).encode("utf-8")
+    state.index_etag = f'"{hashlib.sha256(state.index_body).hexdigest()[:16]}"'
+    installed_signals = install_signal_handlers()
     yield
-    # Shutdown
-    state.should_stop = True
-    if state.task:
-        state.task.cancel()
+    # Shutdown - let the loop exit on its own, cancel it if that takes too long
+    restore_signal_handlers(installed_signals)
+    if state.stop_event:
+        state.stop_event.set()
+    if state.task and not state.task.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(state.task), timeout=SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            state.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await state.task
+        except asyncio.CancelledError:
+            # The loop task being cancelled is fine; lifespan being cancelled is not
+            if not state.task.cancelled():
+                raise
+
+    # Let the writer flush queued console output in order, then stop it
+    try:
+        await asyncio.wait_for(state.log_q.join(), timeout=SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    state.log_writer_task.cancel()
+    try:
+        await state.log_writer_task
+    except asyncio.CancelledError:
+        pass
+    state.log_q = None
 
 app = FastAPI(title="OCI ARM VM Monitor", lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
@@ -260,20 +533,23 @@ templates = Jinja2Templates(directory="templates")
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request, username: str = Depends(verify_credentials)):
     """Serve the main monitoring UI"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    # private: the page sits behind basic auth, so shared caches must not store it
+    headers = {"ETag": state.index_etag, "Cache-Control": "private, max-age=60"}
+    if request.headers.get("if-none-match") == state.index_etag:
+        return Response(status_code=304, headers=headers)
+    return Response(state.index_body, media_type="text/html", headers=headers)
 
 @app.post("/api/start")
 async def start_creation(username: str = Depends(verify_credentials)):
     """Start the VM creation loop"""
-    if state.is_running:
+    if state.snapshot["is_running"]:
         return JSONResponse({"status": "error", "message": "Already running"}, status_code=400)
 
-    state.is_running = True
-    state.should_stop = False
-    state.vm_created = False
-    state.vm_details = None
-    state.logs = []
-    state.current_attempt = 0
+    state.stop_event = asyncio.Event()
+    # Keep indices monotonic across runs so clients' since/last_index stay valid
+    state.log_offset += len(state.logs)
+    state.logs.clear()
+    update_status(is_running=True, vm_created=False, vm_details=None, current_attempt=0)
 
     # Start background task
     state.task = asyncio.create_task(vm_creation_loop())
@@ -283,10 +559,10 @@ async def start_creation(username: str = Depends(verify_credentials)):
 @app.post("/api/stop")
 async def stop_creation(username: str = Depends(verify_credentials)):
     """Stop the VM creation loop"""
-    if not state.is_running:
+    if not state.snapshot["is_running"]:
         return JSONResponse({"status": "error", "message": "Not running"}, status_code=400)
 
-    state.should_stop = True
+    state.stop_event.set()
     add_log("Stop requested...", "info")
 
     return {"status": "ok", "message": "Stop requested"}
@@ -294,50 +570,53 @@ async def stop_creation(username: str = Depends(verify_credentials)):
 @app.get("/api/status")
 async def get_status(username: str = Depends(verify_credentials)):
     """Get current status"""
-    return {
-        "is_running": state.is_running,
-        "current_attempt": state.current_attempt,
-        "last_status": state.last_status,
-        "vm_created": state.vm_created,
-        "vm_details": state.vm_details,
-        "log_count": len(state.logs)
-    }
+    return {**state.snapshot, "log_count": len(state.logs)}
 
 @app.get("/api/logs")
 async def get_logs(since: int = 0, username: str = Depends(verify_credentials)):
     """Get logs since index"""
+    logs, total = get_logs_since(since)
     return {
-        "logs": state.logs[since:],
-        "total": len(state.logs)
+        "logs": logs,
+        "total": total
     }
 
+# Status fields pushed over SSE (vm_details is fetched via /api/status)
+STREAM_STATUS_FIELDS = ("is_running", "current_attempt", "last_status", "vm_created")
+
+def sse_frame(event_type: str, data) -> bytes:
+    """Encode one SSE data frame"""
+    return b"data: " + orjson.dumps({"type": event_type, "data": data}) + b"\n\n"
+
 @app.get("/api/stream")
 async def stream_logs(username: str = Depends(verify_credentials)):
     """Server-Sent Events stream for live logs"""
     async def event_generator():
         last_index = 0
-        last_status = ""
+        last_status = None
 
         while True:
-            # Send new logs
-            if len(state.logs) > last_index:
-                new_logs = state.logs[last_index:]
-                for log in new_logs:
-                    yield f"data: {json.dumps({'type': 'log', 'data': log})}\n\n"
-                last_index = len(state.logs)
+            seen_version = state.status_version
+            frames = []
+
+            # Send new logs as a single batch frame
+            if state.log_offset + len(state.logs) > last_index:
+                new_logs, last_index = get_logs_since(last_index)
+                frames.append(sse_frame("log_batch", new_logs))
 
             # Send status updates
-            current_status = json.dumps({
-                "is_running": state.is_running,
-                "current_attempt": state.current_attempt,
-                "last_status": state.last_status,
-                "vm_created": state.vm_created
-            })
+            snapshot = state.snapshot
+            current_status = {k: snapshot[k] for k in STREAM_STATUS_FIELDS}
             if current_status != last_status:
-                yield f"data: {json.dumps({'type': 'status', 'data': json.loads(current_status)})}\n\n"
+                frames.append(sse_frame("status", current_status))
                 last_status = current_status
 
-            await asyncio.sleep(0.5)
+            if frames:
+                yield b"".join(frames)
+
+            # Sleep until add_log/notify_clients reports a change
+            async with state.log_cond:
+                await state.log_cond.wait_for(lambda: state.status_version != seen_version)
 
     return StreamingResponse(
         event_generator(),
@@ -346,7 +625,6 @@ async def stream_logs(username: str = Depends(verify_credentials)):
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
             "X-Accel-Buffering": "no",
-            "Transfer-Encoding": "chunked",
         }
     )
 